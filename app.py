@@ -1,13 +1,23 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context, url_for
 import random
 import logging
 import copy
 import math
+import hashlib
+import json
+import re
+import secrets
+from datetime import date, datetime, timedelta, timezone
 from collections import Counter, defaultdict
+from urllib.parse import quote
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+# Registered semesters, keyed by semester id
+semesters = {}
+
 class TimeTableGenerator:
     def __init__(self):
         self.days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
@@ -578,6 +588,379 @@ class TimeTableGenerator:
             
         return analysis
 
+class SemesterCalendar:
+    """
+    Expands a weekly timetable over a semester date range, honouring
+    holidays, exam weeks and one-off cancellations. Occurrences and
+    iCalendar lines are produced lazily so a feed never holds the whole term.
+
+    A calendar is never modified once built; updating a semester replaces it
+    with a new calendar under the same id, so feeds being streamed keep a
+    consistent view.
+    """
+    BLOCKING_EXCEPTIONS = ('holiday', 'exam')
+    FEED_KINDS = ('batch', 'faculty', 'room')
+    MAX_SEMESTER_DAYS = 366
+
+    def __init__(self, timetable, start_date, end_date, exceptions=None, tz_name=None,
+                 semester_id=None, version=1, edit_token=None, previous_updated=None, generator=None):
+        self.generator = generator or TimeTableGenerator()
+        self.timetable = self.validate_timetable(timetable)
+        self.start_date = self.parse_date(start_date)
+        self.end_date = self.parse_date(end_date)
+        if self.end_date < self.start_date:
+            raise ValueError("Semester end_date must not be before start_date")
+        if (self.end_date - self.start_date).days >= self.MAX_SEMESTER_DAYS:
+            raise ValueError(f"A semester cannot be longer than {self.MAX_SEMESTER_DAYS} days")
+
+        self.tz_name = tz_name
+        self.tz = None
+        if tz_name is not None:
+            try:
+                self.tz = ZoneInfo(tz_name)
+            except (ZoneInfoNotFoundError, ValueError, TypeError):
+                raise ValueError(f"Unknown timezone: {tz_name}")
+
+        if exceptions is None:
+            exceptions = []
+        if not isinstance(exceptions, list):
+            raise ValueError("exceptions must be a list")
+
+        self.exceptions = exceptions
+        self.blocked_dates = {}
+        self.cancellations = defaultdict(list)
+        for exception in self.exceptions:
+            if not isinstance(exception, dict):
+                raise ValueError(f"Each exception must be an object: {exception}")
+            kind = exception.get('type', 'cancellation')
+            if kind in self.BLOCKING_EXCEPTIONS:
+                first, last = self.exception_range(exception)
+                if last < first:
+                    raise ValueError(f"Exception ends before it starts: {exception}")
+                # Only days inside the semester can ever be looked up
+                first = max(first, self.start_date)
+                last = min(last, self.end_date)
+                for offset in range((last - first).days + 1):
+                    self.blocked_dates[first + timedelta(days=offset)] = exception
+            elif kind == 'cancellation':
+                if 'slot' in exception and exception['slot'] not in self.generator.time_slots:
+                    raise ValueError(f"Unknown slot in cancellation: {exception['slot']}")
+                self.cancellations[self.parse_date(exception['date'])].append(exception)
+            else:
+                raise ValueError(f"Unknown exception type: {kind}")
+
+        self.semester_id = semester_id or secrets.token_hex(8)
+        # Kept out of feed URLs; only the registrant may update the semester
+        self.edit_token = edit_token or secrets.token_urlsafe(24)
+        self.version = version
+        # Digest of the semester definition and version; used as the ETag base
+        canonical = json.dumps({
+            'timetable': self.timetable,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'exceptions': self.exceptions,
+            'timezone': self.tz_name,
+            'version': self.version
+        }, sort_keys=True, separators=(',', ':'))
+        self.digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+        # Last-Modified has one-second resolution, so every version must move it forward
+        self.updated = datetime.now(timezone.utc).replace(microsecond=0)
+        if previous_updated is not None and self.updated <= previous_updated:
+            self.updated = previous_updated + timedelta(seconds=1)
+        self.slot_times = [self.parse_slot(slot) for slot in self.generator.time_slots]
+
+        # Feeds are addressed by an opaque key so names never appear in URLs
+        self.feed_names = {kind: {} for kind in self.FEED_KINDS}
+        for slots in self.timetable.values():
+            for slot in slots:
+                for batch_key, entry in slot.items():
+                    if batch_key != 'whole_class':
+                        self.feed_names['batch'][self.feed_key('batch', batch_key)] = batch_key
+                    if entry and entry.get('type') in ('theory', 'lab'):
+                        for kind in ('faculty', 'room'):
+                            if entry.get(kind):
+                                self.feed_names[kind][self.feed_key(kind, entry[kind])] = entry[kind]
+        self.weekly_cache = {}
+        self.vtimezone = self.build_vtimezone() if self.tz else []
+
+    def validate_timetable(self, timetable):
+        if not isinstance(timetable, dict) or not timetable:
+            raise ValueError("timetable must be an object mapping days to slots")
+        for day, slots in timetable.items():
+            if day not in self.generator.days:
+                raise ValueError(f"Unknown day in timetable: {day}")
+            if not isinstance(slots, list) or len(slots) > len(self.generator.time_slots):
+                raise ValueError(f"Slots for {day} must be a list of at most "
+                                 f"{len(self.generator.time_slots)} entries")
+            for slot in slots:
+                if not isinstance(slot, dict):
+                    raise ValueError(f"Each slot for {day} must be an object")
+                for entry in slot.values():
+                    if entry is None:
+                        continue
+                    if not isinstance(entry, dict):
+                        raise ValueError(f"Invalid timetable entry on {day}: {entry}")
+                    if entry.get('type') in ('theory', 'lab'):
+                        if not isinstance(entry.get('subject'), str):
+                            raise ValueError(f"Timetable entry on {day} has no subject")
+                        for field in ('faculty', 'room'):
+                            if entry.get(field) is not None and not isinstance(entry[field], str):
+                                raise ValueError(f"Timetable entry on {day} has an invalid {field}")
+        return timetable
+
+    @staticmethod
+    def parse_date(value):
+        if isinstance(value, date):
+            return value
+        if not isinstance(value, str):
+            raise ValueError(f"Invalid date: {value}")
+        return datetime.strptime(value, '%Y-%m-%d').date()
+
+    def exception_range(self, exception):
+        first = self.parse_date(exception.get('start') or exception['date'])
+        last = self.parse_date(exception.get('end') or exception.get('start') or exception['date'])
+        return first, last
+
+    @staticmethod
+    def parse_slot(slot):
+        """Convert a slot label like '1:00-2:00' into 24-hour (hour, minute) pairs"""
+        times = []
+        for part in slot.split('-'):
+            hour, minute = (int(x) for x in part.strip().split(':'))
+            # Slot labels omit AM/PM; the college day runs 8 AM to 8 PM
+            if hour < 8:
+                hour += 12
+            times.append((hour, minute))
+        return times[0], times[1]
+
+    @staticmethod
+    def feed_key(kind, name):
+        return hashlib.sha256(f'{kind}:{name}'.encode('utf-8')).hexdigest()[:12]
+
+    def has_feed(self, kind, name):
+        return self.feed_key(kind, name) in self.feed_names.get(kind, {})
+
+    def feed_name(self, kind, key):
+        """Resolve a feed key from a URL back to its batch, faculty or room name"""
+        return self.feed_names.get(kind, {}).get(key)
+
+    @staticmethod
+    def feed_filename(kind, name):
+        """Content-Disposition value with an ASCII fallback and an RFC 5987 UTF-8 filename"""
+        filename = f'{kind}-{name}.ics'
+        fallback = re.sub(r'[^A-Za-z0-9._-]+', '_', filename)
+        if fallback == filename:
+            return f'inline; filename="{filename}"'
+        return f"inline; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+    def entries_for(self, kind, name):
+        """
+        Weekly sessions for one batch, faculty or room as (day, slot, batch_key, entry)
+        tuples. Computed once per feed and reused by every subscriber request.
+        """
+        key = (kind, name)
+        if key in self.weekly_cache:
+            return self.weekly_cache[key]
+
+        entries = []
+        for day in self.generator.days:
+            for slot_idx, slot_data in enumerate(self.timetable.get(day, [])):
+                if kind == 'batch':
+                    entry = slot_data.get(name)
+                    if entry and entry.get('type') in ('theory', 'lab'):
+                        entries.append((day, slot_idx, name, entry))
+                    continue
+
+                # Theory classes are duplicated into every batch, so take them from
+                # whole_class and only pick up batch-specific lab sessions.
+                for batch_key, entry in slot_data.items():
+                    if not entry or entry.get('type') not in ('theory', 'lab'):
+                        continue
+                    if batch_key != 'whole_class' and entry.get('with_whole_class', False):
+                        continue
+                    if entry.get(kind) == name:
+                        entries.append((day, slot_idx, batch_key, entry))
+
+        # Only names that have a feed are cached, so lookups cannot grow it
+        if self.has_feed(kind, name):
+            self.weekly_cache[key] = entries
+        return entries
+
+    def is_cancelled(self, day_date, slot_idx, batch_key, entry):
+        for cancellation in self.cancellations.get(day_date, []):
+            if 'slot' in cancellation and cancellation['slot'] != self.generator.time_slots[slot_idx]:
+                continue
+            # A batch-specific cancellation only applies to that batch's own sessions,
+            # never to a lecture shared with the whole class
+            if 'batch' in cancellation and (batch_key != cancellation['batch']
+                                            or entry.get('with_whole_class', False)):
+                continue
+            if any(field in cancellation and cancellation[field] != entry.get(field)
+                   for field in ('subject', 'faculty', 'room')):
+                continue
+            return True
+        return False
+
+    def iter_occurrences(self, kind, name):
+        """Lazily yield (date, slot_idx, batch_key, entry) for every class held in the semester"""
+        by_weekday = defaultdict(list)
+        for day, slot_idx, batch_key, entry in self.entries_for(kind, name):
+            by_weekday[self.generator.days.index(day)].append((slot_idx, batch_key, entry))
+
+        day_date = self.start_date
+        while day_date <= self.end_date:
+            if day_date not in self.blocked_dates:
+                for slot_idx, batch_key, entry in by_weekday.get(day_date.weekday(), []):
+                    if not self.is_cancelled(day_date, slot_idx, batch_key, entry):
+                        yield day_date, slot_idx, batch_key, entry
+            day_date += timedelta(days=1)
+
+    def etag(self, kind, name):
+        return hashlib.sha256(f'{self.digest}:{kind}:{name}'.encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def format_offset(offset):
+        minutes = int(offset.total_seconds()) // 60
+        sign = '+' if minutes >= 0 else '-'
+        return f'{sign}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}'
+
+    def build_vtimezone(self):
+        """
+        VTIMEZONE lines for the semester's timezone, covering every offset
+        change between the start and end of the term.
+        """
+        def local_state(instant):
+            local = instant.astimezone(self.tz)
+            return local.utcoffset(), local.dst(), local.tzname()
+
+        start = datetime(self.start_date.year, self.start_date.month, self.start_date.day,
+                         tzinfo=timezone.utc) - timedelta(days=1)
+        end = datetime(self.end_date.year, self.end_date.month, self.end_date.day,
+                       tzinfo=timezone.utc) + timedelta(days=2)
+
+        # Walk the term a day at a time, then narrow each change down to the second
+        periods = [(None, local_state(start))]
+        instant = start
+        while instant < end:
+            following = instant + timedelta(days=1)
+            if local_state(following) != periods[-1][1]:
+                low, high = instant, following
+                while high - low > timedelta(seconds=1):
+                    middle = low + timedelta(seconds=(high - low).total_seconds() // 2)
+                    if local_state(middle) == periods[-1][1]:
+                        low = middle
+                    else:
+                        high = middle
+                periods.append((high, local_state(high)))
+            instant = following
+
+        lines = ['BEGIN:VTIMEZONE', f'TZID:{self.tz_name}']
+        previous_offset = periods[0][1][0]
+        for onset, (offset, dst, tzname) in periods:
+            component = 'DAYLIGHT' if dst else 'STANDARD'
+            # Onsets are written in the local time in force just before the change
+            local_onset = (onset + previous_offset).replace(tzinfo=None) if onset else datetime(1970, 1, 1)
+            lines += [
+                f'BEGIN:{component}',
+                f'DTSTART:{local_onset:%Y%m%dT%H%M%S}',
+                f'TZOFFSETFROM:{self.format_offset(previous_offset)}',
+                f'TZOFFSETTO:{self.format_offset(offset)}',
+                f'TZNAME:{self.escape_text(tzname)}',
+                f'END:{component}',
+            ]
+            previous_offset = offset
+        lines.append('END:VTIMEZONE')
+        return lines
+
+    @staticmethod
+    def escape_text(value):
+        return (str(value).replace('\\', '\\\\').replace(';', '\\;')
+                .replace(',', '\\,').replace('\n', '\\n'))
+
+    @staticmethod
+    def fold_line(line):
+        """Fold a content line to 75 octets as required by RFC 5545"""
+        encoded = line.encode('utf-8')
+        if len(encoded) <= 75:
+            return line + '\r\n'
+        parts = []
+        limit = 75
+        while encoded:
+            cut = min(limit, len(encoded))
+            # Never split inside a multi-byte UTF-8 sequence
+            while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+                cut -= 1
+            parts.append(encoded[:cut].decode('utf-8'))
+            encoded = encoded[cut:]
+            limit = 74
+        return '\r\n '.join(parts) + '\r\n'
+
+    def iter_ics(self, kind, name):
+        """Generate the iCalendar feed for one batch, faculty or room chunk by chunk"""
+        fold = self.fold_line
+        stamp = self.updated.strftime('%Y%m%dT%H%M%SZ')
+        label = name.replace('_', ' ').title() if kind == 'batch' else name
+        # Without a timezone, times are floating and shown in each subscriber's local time
+        time_param = f';TZID={self.escape_text(self.tz_name)}' if self.tz else ''
+
+        yield ''.join(fold(line) for line in [
+            'BEGIN:VCALENDAR',
+            'VERSION:2.0',
+            'PRODID:-//Planova//Smart Timetable Generator//EN',
+            'CALSCALE:GREGORIAN',
+            'METHOD:PUBLISH',
+            f'X-WR-CALNAME:{self.escape_text(label)} Timetable',
+        ] + self.vtimezone)
+
+        seen = set()
+        for exception in self.exceptions:
+            if exception.get('type', 'cancellation') not in self.BLOCKING_EXCEPTIONS:
+                continue
+            first, last = self.exception_range(exception)
+            if last < self.start_date or first > self.end_date:
+                continue
+            if (exception['type'], first) in seen:
+                continue
+            seen.add((exception['type'], first))
+            summary = exception.get('reason') or ('Exam Week' if exception['type'] == 'exam' else 'Holiday')
+            yield ''.join(fold(line) for line in (
+                'BEGIN:VEVENT',
+                f'UID:{self.semester_id}-{exception["type"]}-{first:%Y%m%d}@planova',
+                f'DTSTAMP:{stamp}',
+                f'DTSTART;VALUE=DATE:{first:%Y%m%d}',
+                f'DTEND;VALUE=DATE:{last + timedelta(days=1):%Y%m%d}',
+                f'SUMMARY:{self.escape_text(summary)}',
+                'TRANSP:TRANSPARENT',
+                'END:VEVENT',
+            ))
+
+        for day_date, slot_idx, batch_key, entry in self.iter_occurrences(kind, name):
+            (start_hour, start_minute), (end_hour, end_minute) = self.slot_times[slot_idx]
+            summary = entry['subject']
+            if entry.get('type') == 'lab':
+                summary = f"{summary} (Lab)"
+            description = f"Faculty: {entry.get('faculty')}"
+            if entry.get('with_whole_class', False):
+                # Shared lectures get the same UID in batch, faculty and room feeds
+                uid_key = 'whole_class'
+            else:
+                uid_key = batch_key
+                if batch_key != 'whole_class':
+                    description += f"\nBatch: {batch_key.replace('_', ' ').title()}"
+            yield ''.join(fold(line) for line in (
+                'BEGIN:VEVENT',
+                f'UID:{self.semester_id}-{day_date:%Y%m%d}-{slot_idx}-{uid_key}@planova',
+                f'DTSTAMP:{stamp}',
+                f'DTSTART{time_param}:{day_date:%Y%m%d}T{start_hour:02d}{start_minute:02d}00',
+                f'DTEND{time_param}:{day_date:%Y%m%d}T{end_hour:02d}{end_minute:02d}00',
+                f'SUMMARY:{self.escape_text(summary)}',
+                f'LOCATION:{self.escape_text(entry.get("room") or "")}',
+                f'DESCRIPTION:{self.escape_text(description)}',
+                'END:VEVENT',
+            ))
+
+        yield fold('END:VCALENDAR')
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -652,5 +1035,138 @@ def generate():
         app.logger.error(f"Error generating timetable: {str(e)}")
         return jsonify({"error": f"Error generating timetable: {str(e)}"}), 500
 
+
+def semester_details(semester):
+    def feed_url(kind, name):
+        return url_for('semester_feed', semester_id=semester.semester_id, kind=kind,
+                       key=semester.feed_key(kind, name), _external=True)
+
+    return {
+        "semester_id": semester.semester_id,
+        "version": semester.version,
+        "feeds": {
+            kind: {name: feed_url(kind, name) for name in sorted(semester.feed_names[kind].values())}
+            for kind in SemesterCalendar.FEED_KINDS
+        }
+    }
+
+
+@app.route('/semester', methods=['POST'])
+def create_semester():
+    try:
+        if not request.is_json:
+            app.logger.error("Invalid request format, expected JSON")
+            return jsonify({"error": "Invalid request format, expected JSON"}), 400
+
+        data = request.get_json()
+        if not isinstance(data, dict):
+            app.logger.error("Failed to parse JSON data")
+            return jsonify({"error": "Failed to parse JSON data"}), 400
+
+        timetable = data.get('timetable')
+        if not timetable:
+            return jsonify({"error": "A generated timetable is required"}), 400
+
+        semester = SemesterCalendar(
+            timetable,
+            data['start_date'],
+            data['end_date'],
+            data.get('exceptions', []),
+            data.get('timezone')
+        )
+        semesters[semester.semester_id] = semester
+
+        app.logger.debug(f"Semester {semester.semester_id} registered")
+        # The edit token is only ever returned here; it is needed for PATCH
+        return jsonify({**semester_details(semester), "edit_token": semester.edit_token})
+    except KeyError as ke:
+        app.logger.error(f"Missing required data: {str(ke)}")
+        return jsonify({"error": f"Missing required data: {str(ke)}"}), 400
+    except ValueError as ve:
+        app.logger.error(f"Invalid data format: {str(ve)}")
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        app.logger.error(f"Error creating semester: {str(e)}")
+        return jsonify({"error": f"Error creating semester: {str(e)}"}), 500
+
+
+@app.route('/semester/<semester_id>', methods=['PATCH'])
+def update_semester(semester_id):
+    try:
+        semester = semesters.get(semester_id)
+        if semester is None:
+            return jsonify({"error": "Unknown semester"}), 404
+
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not token or not secrets.compare_digest(token, semester.edit_token):
+            app.logger.error(f"Rejected update to semester {semester_id}: invalid edit token")
+            return jsonify({"error": "A valid edit token is required"}), 403
+
+        if not request.is_json:
+            app.logger.error("Invalid request format, expected JSON")
+            return jsonify({"error": "Invalid request format, expected JSON"}), 400
+
+        data = request.get_json()
+        if not isinstance(data, dict):
+            app.logger.error("Failed to parse JSON data")
+            return jsonify({"error": "Failed to parse JSON data"}), 400
+
+        # The id stays the same so existing subscriptions pick up the change
+        updated = SemesterCalendar(
+            semester.timetable,
+            data.get('start_date', semester.start_date),
+            data.get('end_date', semester.end_date),
+            data.get('exceptions', semester.exceptions),
+            data.get('timezone', semester.tz_name),
+            semester_id=semester_id,
+            version=semester.version + 1,
+            edit_token=semester.edit_token,
+            previous_updated=semester.updated
+        )
+        semesters[semester_id] = updated
+
+        app.logger.debug(f"Semester {semester_id} updated to version {updated.version}")
+        return jsonify(semester_details(updated))
+    except KeyError as ke:
+        app.logger.error(f"Missing required data: {str(ke)}")
+        return jsonify({"error": f"Missing required data: {str(ke)}"}), 400
+    except ValueError as ve:
+        app.logger.error(f"Invalid data format: {str(ve)}")
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        app.logger.error(f"Error updating semester: {str(e)}")
+        return jsonify({"error": f"Error updating semester: {str(e)}"}), 500
+
+
+@app.route('/semester/<semester_id>/<kind>/<key>.ics')
+def semester_feed(semester_id, kind, key):
+    semester = semesters.get(semester_id)
+    if semester is None:
+        return jsonify({"error": "Unknown semester"}), 404
+    if kind not in SemesterCalendar.FEED_KINDS:
+        return jsonify({"error": "Feed type must be batch, faculty or room"}), 404
+    name = semester.feed_name(kind, key)
+    if name is None:
+        return jsonify({"error": f"Unknown {kind} feed"}), 404
+
+    # The ETag only depends on the semester definition and version, so polling
+    # clients get a 304 without the term being expanded at all.
+    etag = semester.etag(kind, name)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': semester.updated.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        'Cache-Control': 'public, max-age=3600'
+    }
+    if request.if_none_match.contains_weak(etag) or (
+            not request.if_none_match and request.if_modified_since
+            and request.if_modified_since >= semester.updated):
+        return Response(status=304, headers=headers)
+
+    return Response(
+        stream_with_context(semester.iter_ics(kind, name)),
+        mimetype='text/calendar',
+        headers={**headers, 'Content-Disposition': semester.feed_filename(kind, name)}
+    )
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file